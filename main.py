@@ -1,9 +1,14 @@
 import os
+import re
+import asyncio
 import logging
 import sqlite3
+import threading
+from contextlib import contextmanager
 from sqlite3 import Error
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import (
+    AIORateLimiter,
     Application,
     CommandHandler,
     MessageHandler,
@@ -13,9 +18,9 @@ from telegram.ext import (
     CallbackContext,
 )
 import aiohttp
-from bs4 import BeautifulSoup
+from bs4 import BeautifulSoup, SoupStrainer
 import datetime
-import pytz
+from zoneinfo import ZoneInfo
 from cachetools import TTLCache
 from dotenv import load_dotenv
 
@@ -32,7 +37,8 @@ logger = logging.getLogger(__name__)
 TOKEN = os.getenv("BOT_TOKEN")
 DATABASE = os.getenv("DATABASE")
 
-CACHE_TIMEOUT = 3600  # 1 час кэширования
+CACHE_TIMEOUT = 86400  # 24 часа кэширования: расписание меняется раз в сутки
+SCHEDULE_RETRY_INTERVAL = 300  # Повтор планирования, если расписание не загрузилось
 CITIES = {
     'Москва': 'moscow',
     'Казань': 'kazan',
@@ -63,40 +69,139 @@ CITY_TIMEZONES = {
     'uralsk': 'Asia/Oral',
 }
 
+# Код города -> (название, часовой пояс) для обратного поиска без перебора CITIES
+CITY_BY_CODE = {code: (ru_name, CITY_TIMEZONES[code]) for ru_name, code in CITIES.items()}
+
+MSK = ZoneInfo('Europe/Moscow')
+
+# Разбираем только нужные фрагменты страниц umma.ru
+PRAYER_TABLE_STRAINER = SoupStrainer('table', class_='PrayTimePage_table__wEx0t')
+QUOTE_BLOCK_STRAINER = SoupStrainer('div', class_='DailyNews_dailyNewsText__5XStP')
+
 PRAYER_NAMES = ['Фаджр', 'Шурук', 'Зухр', 'Аср', 'Магриб', 'Иша']
 
+# Кнопки главного меню
+MENU_SCHEDULE = "📅 Расписание на сегодня"
+MENU_AYAT = "📖 Аят дня"
+MENU_SETTINGS = "⚙️ Настройки"
+
+SETTINGS_TEXT = (
+    "⚙️ *Настройки*\n"
+    "Список доступных команд:\n"
+    "/start - ℹ️ Начало работы с ботом\n"
+    "/set_city _- 🏠 Выбрать город вручную\n"
+    "/status - ℹ️ Показать текущие настройки\n"
+    "/daily_quote _- 📖 Аят дня\n"
+    "/subscribe - ✅ Подписаться на уведомления\n"
+    "/unsubscribe - ❌ Отписаться от уведомлений\n\n"
+    "Выберите действие ниже:"
+)
+
+# Клавиатуры неизменяемы, поэтому собираем их один раз
+MAIN_KEYBOARD = ReplyKeyboardMarkup(
+    [[KeyboardButton(MENU_SCHEDULE)], [KeyboardButton(MENU_AYAT)], [KeyboardButton(MENU_SETTINGS)]],
+    resize_keyboard=True
+)
+CITY_BUTTONS = [[InlineKeyboardButton(city, callback_data=f"set_city_{city}")] for city in CITIES]
+CITY_KEYBOARD = InlineKeyboardMarkup(CITY_BUTTONS)
+CITY_KEYBOARD_WITH_BACK = InlineKeyboardMarkup(
+    CITY_BUTTONS + [[InlineKeyboardButton("⬅️ Назад", callback_data="back_to_settings")]]
+)
+SETTINGS_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🏠 Изменить город", callback_data="change_city")],
+    [InlineKeyboardButton("ℹ️ Текущие настройки", callback_data="show_settings")]
+])
+
 # Глобальный кэш
-cache = TTLCache(maxsize=100, ttl=CACHE_TIMEOUT)
+cache = TTLCache(maxsize=200, ttl=CACHE_TIMEOUT)
+# Страницы umma.ru для условных запросов: url -> (ETag, Last-Modified, html)
+page_cache = TTLCache(maxsize=50, ttl=CACHE_TIMEOUT)
 daily_quotes = {'ayat': None}
-sent_notifications = {}
-sent_daily_schedules = {}
+# Сработавшие задания ежедневного расписания: после запуска run_once они пропадают
+# из очереди, и повторный проход в окне до Фаджр создал бы их заново
+fired_jobs = TTLCache(maxsize=1000, ttl=2 * CACHE_TIMEOUT)
+
+# Общая HTTP-сессия: создаётся в post_init, закрывается в post_shutdown
+SESSION: aiohttp.ClientSession | None = None
+FETCH_SEMAPHORE = asyncio.Semaphore(6)  # Не больше 6 одновременных запросов к umma.ru
+
+
+# Единое соединение с БД на всё время работы бота
+_DB_CONN = None
+_DB_LOCK = threading.Lock()
+# Подписчики в памяти: сбрасываются при любой записи в БД, защищены _DB_LOCK
+_SUBSCRIBERS: list[dict] | None = None
+
+
+def _connect() -> sqlite3.Connection:
+    conn = sqlite3.connect(DATABASE, check_same_thread=False, isolation_level=None)
+    if DATABASE != ":memory:":
+        # WAL сохраняется в файле БД, остальные настройки действуют на соединение
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA temp_store=MEMORY")
+        conn.execute("PRAGMA cache_size=-65536")
+    return conn
+
+
+@contextmanager
+def db_read():
+    with _DB_LOCK:
+        yield _DB_CONN.cursor()
+
+
+@contextmanager
+def db_write():
+    global _SUBSCRIBERS
+    # BEGIN IMMEDIATE сразу берёт блокировку на запись и исключает SQLITE_BUSY посреди транзакции
+    with _DB_LOCK:
+        cursor = _DB_CONN.cursor()
+        cursor.execute("BEGIN IMMEDIATE")
+        try:
+            yield cursor
+            cursor.execute("COMMIT")
+        except BaseException:
+            # Неудачный COMMIT тоже оставляет транзакцию открытой на общем соединении
+            if _DB_CONN.in_transaction:
+                cursor.execute("ROLLBACK")
+            raise
+        _SUBSCRIBERS = None
 
 
 # Инициализация БД
-def init_db():
+def init_db() -> bool:
+    global _DB_CONN
     try:
-        with sqlite3.connect(DATABASE) as conn:
-            cursor = conn.cursor()
+        if _DB_CONN is None:
+            _DB_CONN = _connect()
+        with db_write() as cursor:
             cursor.execute('''CREATE TABLE IF NOT EXISTS subscribers
                              (chat_id INTEGER PRIMARY KEY,
                               city TEXT,
                               timezone TEXT,
                               subscribed INTEGER DEFAULT 1)''')
-            conn.commit()
+            # Частичный покрывающий индекс: выборка подписчиков не читает саму таблицу
+            cursor.execute('''CREATE INDEX IF NOT EXISTS idx_subs_active
+                             ON subscribers(subscribed, city) WHERE subscribed = 1''')
+        with db_read() as cursor:
+            cursor.execute("PRAGMA optimize")
         logger.info("База данных успешно инициализирована")
+        return True
     except Error as e:
         logger.error(f"Ошибка инициализации БД: {e}")
+        return False
 
 
 # Функции работы с БД
 def get_subscribed_users():
+    global _SUBSCRIBERS
     try:
-        with sqlite3.connect(DATABASE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT chat_id, city, timezone FROM subscribers WHERE subscribed = 1")
-            users = [{'chat_id': row[0], 'city': row[1], 'tz': row[2]} for row in cursor.fetchall()]
-            logger.info(f"Найдено {len(users)} подписанных пользователей")
-            return users
+        with db_read() as cursor:
+            if _SUBSCRIBERS is None:
+                cursor.execute("SELECT chat_id, city FROM subscribers WHERE subscribed = 1")
+                _SUBSCRIBERS = [{'chat_id': row[0], 'city': row[1]} for row in cursor.fetchall()]
+                logger.info(f"Найдено {len(_SUBSCRIBERS)} подписанных пользователей")
+            return _SUBSCRIBERS
     except Error as e:
         logger.error(f"Ошибка при получении подписчиков: {e}")
         return []
@@ -104,12 +209,12 @@ def get_subscribed_users():
 
 def update_user(chat_id: int, city: str, timezone: str):
     try:
-        with sqlite3.connect(DATABASE) as conn:
-            cursor = conn.cursor()
-            cursor.execute('''INSERT OR REPLACE INTO subscribers 
-                             (chat_id, city, timezone, subscribed) 
-                             VALUES (?, ?, ?, 1)''', (chat_id, city, timezone))
-            conn.commit()
+        with db_write() as cursor:
+            cursor.execute('''INSERT INTO subscribers (chat_id, city, timezone, subscribed)
+                             VALUES (?, ?, ?, 1)
+                             ON CONFLICT(chat_id) DO UPDATE SET
+                             city = excluded.city, timezone = excluded.timezone, subscribed = 1''',
+                           (chat_id, city, timezone))
         logger.info(f"Обновление данных о пользователе {chat_id}: город={city}, timezone={timezone}")
     except Error as e:
         logger.error(f"Ошибка при обновлении пользователя {chat_id}: {e}")
@@ -117,10 +222,8 @@ def update_user(chat_id: int, city: str, timezone: str):
 
 def unsubscribe_user(chat_id: int):
     try:
-        with sqlite3.connect(DATABASE) as conn:
-            cursor = conn.cursor()
+        with db_write() as cursor:
             cursor.execute("UPDATE subscribers SET subscribed = 0 WHERE chat_id = ?", (chat_id,))
-            conn.commit()
         logger.info(f"Пользователь {chat_id} отписан")
     except Error as e:
         logger.error(f"Ошибка при отписке пользователя {chat_id}: {e}")
@@ -128,16 +231,94 @@ def unsubscribe_user(chat_id: int):
 
 # Парсинг данных
 async def fetch_url(url: str) -> str:
+    cached = page_cache.get(url)
+    headers = {}
+    if cached:
+        etag, last_modified, _ = cached
+        if etag:
+            headers['If-None-Match'] = etag
+        if last_modified:
+            headers['If-Modified-Since'] = last_modified
     try:
-        async with aiohttp.ClientSession() as session:
-            async with session.get(url, headers={'User-Agent': 'Mozilla/5.0'}) as response:
-                return await response.text()
+        async with FETCH_SEMAPHORE, SESSION.get(url, headers=headers) as response:
+            if response.status == 304 and cached:
+                logger.debug(f"Страница {url} не изменилась")
+                return cached[2]
+            html = await response.text()
+            etag, last_modified = response.headers.get('ETag'), response.headers.get('Last-Modified')
+            if response.status == 200 and (etag or last_modified):
+                page_cache[url] = (etag, last_modified, html)
+            return html
     except aiohttp.ClientError as e:
         logger.error(f"Ошибка при запросе {url}: {e}")
         return ""
 
 
+def schedule_to_minutes(schedule: dict) -> dict:
+    return {name: int(h) * 60 + int(m) for name, time in schedule.items() for h, m in [time.split(':')]}
+
+
+async def parse_prayer_minutes(city: str, date: datetime.date) -> dict:
+    cache_key = f"{city}_{date}_min"
+    if cache_key in cache:
+        return cache[cache_key]
+    schedule = await parse_prayer_times(city, date)
+    if not schedule:
+        return {}
+    minutes = schedule_to_minutes(schedule)
+    cache[cache_key] = minutes
+    return minutes
+
+
+# Строка таблицы: день, дата и шесть времён намаза
+PRAYER_ROW_RE = re.compile(r'<tr[^>]*>\s*' + r'\s*'.join([r'<td[^>]*>\s*([^<]*?)\s*</td>'] * 8))
+
+
+def find_schedule_row(html: str, day: int) -> list | None:
+    start = html.find('PrayTimePage_table__wEx0t')
+    if start == -1:
+        return None
+    end = html.find('</table>', start)
+    if end == -1:
+        end = len(html)
+    for match in PRAYER_ROW_RE.finditer(html, start, end):
+        if match.group(1) == str(day):
+            return list(match.groups())
+    # Строка дня могла содержать вложенные теги: разбор остаётся за BeautifulSoup
+    return None
+
+
+def find_schedule_row_soup(html: str, city: str, day: int) -> list:
+    soup = BeautifulSoup(html, 'lxml', parse_only=PRAYER_TABLE_STRAINER)
+    table = soup.find('table', class_='PrayTimePage_table__wEx0t')
+    if not table:
+        logger.error(f"Таблица не найдена для {city}")
+        return []
+
+    rows = table.find_all('tr')
+    for i, row in enumerate(rows[:3]):
+        cols = [col.text.strip() for col in row.find_all('td')]
+        logger.debug(f"Строка {i} для {city}: {cols}")
+
+    for row in rows:
+        cols = [col.text.strip() for col in row.find_all('td')]
+        if len(cols) >= 8 and cols[0] == str(day):
+            return cols
+    return []
+
+
+def in_page_month(date: datetime.date) -> bool:
+    # Страница города содержит таблицу текущего (по Москве) месяца, а строки различаются
+    # только номером дня: дата другого месяца совпала бы с чужой строкой
+    today = datetime.datetime.now(MSK).date()
+    return (date.year, date.month) == (today.year, today.month)
+
+
 async def parse_prayer_times(city: str, date: datetime.date) -> dict:
+    if not in_page_month(date):
+        logger.info(f"Расписание для {city} на {date} ещё не опубликовано: страница за другой месяц")
+        return {}
+
     cache_key = f"{city}_{date}"
     if cache_key in cache:
         return cache[cache_key]
@@ -149,31 +330,16 @@ async def parse_prayer_times(city: str, date: datetime.date) -> dict:
             logger.error(f"Не удалось загрузить страницу для {city}")
             return {}
 
-        soup = BeautifulSoup(html, 'html.parser')
-        table = soup.find('table', class_='PrayTimePage_table__wEx0t')
-        if not table:
-            logger.error(f"Таблица не найдена для {city}")
-            return {}
-
-        rows = table.find_all('tr')
-        for i, row in enumerate(rows[:3]):
-            cols = [col.text.strip() for col in row.find_all('td')]
-            logger.debug(f"Строка {i} для {city}: {cols}")
-
-        for row in rows:
-            cols = [col.text.strip() for col in row.find_all('td')]
-            if len(cols) >= 8 and cols[0] == str(date.day):
-                schedule = {
-                    'Фаджр': cols[2],
-                    'Шурук': cols[3],
-                    'Зухр': cols[4],
-                    'Аср': cols[5],
-                    'Магриб': cols[6],
-                    'Иша': cols[7]
-                }
-                cache[cache_key] = schedule
-                logger.info(f"Расписание для {city} на {date}: {schedule}")
-                return schedule
+        cols = find_schedule_row(html, date.day)
+        if cols is None:
+            logger.debug(f"Быстрый разбор не сработал для {city}, используем BeautifulSoup")
+            cols = find_schedule_row_soup(html, city, date.day)
+        if cols:
+            schedule = dict(zip(PRAYER_NAMES, cols[2:8]))
+            cache[cache_key] = schedule
+            cache[f"{cache_key}_min"] = schedule_to_minutes(schedule)
+            logger.info(f"Расписание для {city} на {date}: {schedule}")
+            return schedule
         logger.warning(f"Расписание для {city} на день {date.day} не найдено")
         return {}
     except Exception as e:
@@ -191,7 +357,7 @@ async def get_daily_quote(quote_type: str) -> dict:
         html = await fetch_url(urls[quote_type])
         if not html:
             return {}
-        soup = BeautifulSoup(html, 'html.parser')
+        soup = BeautifulSoup(html, 'lxml', parse_only=QUOTE_BLOCK_STRAINER)
         quote_block = soup.find('div', class_='DailyNews_dailyNewsText__5XStP')
         if not quote_block:
             logger.error(f"Блок цитаты не найден для {quote_type}")
@@ -210,73 +376,159 @@ async def get_daily_quote(quote_type: str) -> dict:
 
 # Обновление данных
 async def update_data(context=None):
-    today = datetime.datetime.now(pytz.timezone('Europe/Moscow')).date()
-    for city in CITIES.values():
-        await parse_prayer_times(city, today)
+    today = datetime.datetime.now(MSK).date()
+    results = await asyncio.gather(
+        *(parse_prayer_times(city, today) for city in CITIES.values()),
+        return_exceptions=True
+    )
+    for city, result in zip(CITIES.values(), results):
+        if isinstance(result, Exception):
+            logger.error(f"Ошибка обновления расписания для {city}: {result}")
     daily_quotes['ayat'] = await get_daily_quote('ayat')
     logger.info("Данные обновлены")
+    if context is not None:
+        await schedule_jobs(context.job_queue)
 
 
-# Отправка ежедневного расписания перед Фаджр
-async def send_daily_prayer_schedule(context: CallbackContext):
-    logger.info("Проверка отправки ежедневного расписания")
-    users = get_subscribed_users()
-    if not users:
-        logger.warning("Нет подписанных пользователей для ежедневного расписания")
+# Планирование уведомлений
+def schedule_once(job_queue, callback, when: datetime.datetime, name: str, data: dict,
+                  now: datetime.datetime, scheduled: set):
+    # Прошедшие события пропускаем, уже запланированные не дублируем
+    if when <= now or name in scheduled:
         return
+    job_queue.run_once(callback, when=when, name=name, data=data)
+    scheduled.add(name)
 
-    now = datetime.datetime.now(pytz.utc)
-    today = now.date()
-    cutoff_date = now - datetime.timedelta(days=1)
-    global sent_daily_schedules
 
-    sent_daily_schedules = {
-        k: v for k, v in sent_daily_schedules.items()
-        if datetime.datetime.strptime(k.split('-')[0], '%Y-%m-%d') > cutoff_date
-    }
+async def retry_schedule_jobs(context: CallbackContext):
+    await schedule_jobs(context.job_queue)
 
-    for user in users:
-        try:
-            city = user['city']
-            tz = pytz.timezone(user['tz'])
-            now = datetime.datetime.now(tz)
-            current_time = now.strftime("%H:%M")
-            schedule = await parse_prayer_times(city, today)
-            if not schedule:
-                logger.warning(f"Расписание для {city} пустое")
-                continue
 
-            fajr_time = schedule.get('Фаджр')
-            if not fajr_time:
-                logger.warning(f"Время Фаджр не найдено для {city}")
+async def schedule_jobs(job_queue):
+    # Планируем сегодня и завтра: ранний Фаджр восточных городов наступает раньше ночного обновления
+    # Имена заданий собираем один раз, а не ищем каждое через get_jobs_by_name
+    scheduled = {job.name for job in job_queue.jobs()} | set(fired_jobs)
+    failed = []
+    month_pending = False
+    for city in CITIES.values():
+        tz = ZoneInfo(CITY_TIMEZONES[city])
+        now = datetime.datetime.now(tz)
+        today = now.date()
+        for date in (today, today + datetime.timedelta(days=1)):
+            if not in_page_month(date):
+                # Дни следующего месяца планируем после его наступления по Москве
+                month_pending = True
                 continue
+            try:
+                schedule = await parse_prayer_times(city, date)
+                minutes = await parse_prayer_minutes(city, date)
+                if not schedule:
+                    if date == today:
+                        failed.append(city)
+                    continue
+                midnight = datetime.datetime.combine(date, datetime.time(), tzinfo=tz)
+                for prayer, prayer_minutes in minutes.items():
+                    schedule_once(
+                        job_queue, notify_prayer, midnight + datetime.timedelta(minutes=prayer_minutes),
+                        name=f"prayer_{city}_{date}_{prayer}",
+                        data={'city': city, 'prayer': prayer, 'time': schedule[prayer]},
+                        now=now, scheduled=scheduled
+                    )
 
-            fajr_minutes = sum(x * int(t) for x, t in zip([60, 1], fajr_time.split(":")))
-            current_minutes = sum(x * int(t) for x, t in zip([60, 1], current_time.split(":")))
-            time_diff = fajr_minutes - current_minutes
-
-            schedule_id = f"{today.strftime('%Y-%m-%d')}-{user['chat_id']}"
-            if 5 <= time_diff <= 15 and schedule_id not in sent_daily_schedules:
-                schedule_text = "🕋 Расписание намазов на сегодня:\n" + "\n".join(
-                    [f"• {name}: <b>{time}</b>" for name, time in schedule.items()]
+                fajr = midnight + datetime.timedelta(minutes=minutes['Фаджр'])
+                when = fajr - datetime.timedelta(minutes=15)
+                if when <= now < fajr - datetime.timedelta(minutes=5):
+                    when = now + datetime.timedelta(seconds=1)
+                schedule_once(
+                    job_queue, send_daily_prayer_schedule, when,
+                    name=f"schedule_{city}_{date}", data={'city': city, 'date': date},
+                    now=now, scheduled=scheduled
                 )
-                await context.bot.send_message(
-                    chat_id=user['chat_id'],
-                    text=schedule_text,
-                    parse_mode='HTML'
+
+                schedule_once(
+                    job_queue, send_daily_quote, datetime.datetime.combine(date, datetime.time(8, 0), tzinfo=tz),
+                    name=f"quote_{city}_{date}", data={'city': city},
+                    now=now, scheduled=scheduled
                 )
-                sent_daily_schedules[schedule_id] = True
-                logger.info(f"Ежедневное расписание отправлено для {user['chat_id']} в {current_time}")
-        except Exception as e:
-            logger.error(f"Ошибка при отправке расписания для {user['chat_id']}: {e}")
+            except Exception as e:
+                logger.error(f"Ошибка планирования уведомлений для {city} на {date}: {e}")
+                if date == today:
+                    failed.append(city)
+    logger.info(f"Запланировано заданий: {len(job_queue.jobs())}")
+
+    # Первое число планируем в 00:01 МСК (02:01 в городах UTC+5), а не в ночное обновление в 01:00 МСК.
+    # Фаджр раньше этого момента по местному времени 1-го числа всё равно будет пропущен
+    if month_pending:
+        msk_tomorrow = datetime.datetime.now(MSK).date() + datetime.timedelta(days=1)
+        name = f"schedule_month_{msk_tomorrow}"
+        if name not in scheduled:
+            when = datetime.datetime.combine(msk_tomorrow, datetime.time(0, 1), tzinfo=MSK)
+            job_queue.run_once(retry_schedule_jobs, when=when, name=name)
+
+    # Города без расписания на сегодня пробуем снова, не дожидаясь ночного обновления
+    if failed and 'schedule_retry' not in scheduled:
+        logger.warning(f"Нет расписания для {', '.join(failed)}, повтор через {SCHEDULE_RETRY_INTERVAL} с")
+        job_queue.run_once(retry_schedule_jobs, when=SCHEDULE_RETRY_INTERVAL, name='schedule_retry')
+
+
+# Рассылка
+def get_city_chat_ids(city: str) -> list:
+    return [user['chat_id'] for user in get_subscribed_users() if user['city'] == city]
+
+
+async def broadcast(context: CallbackContext, chat_ids: list, text: str) -> list:
+    # Темп отправки ограничивает AIORateLimiter приложения
+    results = await asyncio.gather(
+        *(context.bot.send_message(chat_id=chat_id, text=text, parse_mode='HTML') for chat_id in chat_ids),
+        return_exceptions=True
+    )
+    delivered = []
+    for chat_id, result in zip(chat_ids, results):
+        if isinstance(result, Exception):
+            logger.error(f"Ошибка отправки сообщения для {chat_id}: {result}")
+        else:
+            delivered.append(chat_id)
+    return delivered
+
+
+# Уведомление о наступлении времени намаза
+async def notify_prayer(context: CallbackContext):
+    city, prayer, time = context.job.data['city'], context.job.data['prayer'], context.job.data['time']
+    chat_ids = get_city_chat_ids(city)
+    if not chat_ids:
+        return
+    text = f"🕌 Время <u>{prayer}</u> намаза: <b>{time}</b>"
+    for chat_id in await broadcast(context, chat_ids, text):
+        logger.info(f"Уведомление о {prayer} отправлено для {chat_id} в {time}")
+
+
+# Отправка ежедневного расписания перед Фаджр
+async def send_daily_prayer_schedule(context: CallbackContext):
+    city, date = context.job.data['city'], context.job.data['date']
+    fired_jobs[context.job.name] = True
+    logger.info(f"Отправка ежедневного расписания для {city}")
+    chat_ids = get_city_chat_ids(city)
+    if not chat_ids:
+        return
+
+    schedule = await parse_prayer_times(city, date)
+    if not schedule:
+        logger.warning(f"Расписание для {city} пустое")
+        return
+
+    schedule_text = "🕋 Расписание намазов на сегодня:\n" + "\n".join(
+        [f"• {name}: <b>{time}</b>" for name, time in schedule.items()]
+    )
+    for chat_id in await broadcast(context, chat_ids, schedule_text):
+        logger.info(f"Ежедневное расписание отправлено для {chat_id}")
 
 
 # Отправка Аята дня в 8:00 утра
 async def send_daily_quote(context: CallbackContext):
-    logger.info("Отправка Аята дня")
-    users = get_subscribed_users()
-    if not users:
-        logger.warning("Нет подписанных пользователей для Аята дня")
+    city = context.job.data['city']
+    logger.info(f"Отправка Аята дня для {city}")
+    chat_ids = get_city_chat_ids(city)
+    if not chat_ids:
         return
 
     quote = await get_daily_quote('ayat')
@@ -284,30 +536,12 @@ async def send_daily_quote(context: CallbackContext):
         logger.warning("Аят дня не доступен")
         return
 
-    for user in users:
-        try:
-            chat_id = user['chat_id']
-            tz = pytz.timezone(user['tz'])
-            now = datetime.datetime.now(tz)
-            current_time = now.strftime("%H:%M")
-            if current_time == "08:00":  # Проверка на точное время 8:00
-                await context.bot.send_message(
-                    chat_id=chat_id,
-                    text=f"📖 Аят дня:\n{quote['text']}",
-                    parse_mode='HTML'
-                )
-                logger.info(f"Аят дня отправлен для {chat_id} в 8:00")
-        except Exception as e:
-            logger.error(f"Ошибка при отправке Аята дня для {chat_id}: {e}")
+    for chat_id in await broadcast(context, chat_ids, f"📖 Аят дня:\n{quote['text']}"):
+        logger.info(f"Аят дня отправлен для {chat_id} в 8:00")
 
 
 # Обработчики Telegram
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [KeyboardButton("📅 Расписание на сегодня")],
-        [KeyboardButton("📖 Аят дня")],
-        [KeyboardButton("⚙️ Настройки")]
-    ]
     user = update.effective_user
     await update.message.reply_html(
         f"Assalamu Alaikum, {user.mention_html()}! Я буду напоминать вам о времени намаза.\n"
@@ -317,22 +551,21 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         "/daily_quote _- 📖 Аят дня\n"
         "/subscribe - ✅ Подписаться на уведомления\n"
         "/unsubscribe - ❌ Отписаться от уведомлений",
-        reply_markup=ReplyKeyboardMarkup(keyboard, resize_keyboard=True)
+        reply_markup=MAIN_KEYBOARD
     )
 
 
 async def daily_schedule(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     try:
-        with sqlite3.connect(DATABASE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT city, timezone FROM subscribers WHERE chat_id = ?", (chat_id,))
+        with db_read() as cursor:
+            cursor.execute("SELECT city FROM subscribers WHERE chat_id = ?", (chat_id,))
             result = cursor.fetchone()
         if not result:
             await update.message.reply_text("❌ Сначала установите город с помощью /set_city")
             return
-        city, tz = result
-        today = datetime.datetime.now(pytz.timezone(tz)).date()
+        city = result[0]
+        today = datetime.datetime.now(ZoneInfo(CITY_TIMEZONES[city])).date()
         schedule = await parse_prayer_times(city, today)
         if schedule:
             text = "🕋 Расписание на сегодня:\n" + "\n".join(
@@ -356,13 +589,12 @@ async def daily_quote(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     try:
-        with sqlite3.connect(DATABASE) as conn:
-            cursor = conn.cursor()
+        with db_read() as cursor:
             cursor.execute("SELECT city, timezone, subscribed FROM subscribers WHERE chat_id = ?", (chat_id,))
             result = cursor.fetchone()
         if result:
             city, tz, subscribed = result
-            city_name = next((k for k, v in CITIES.items() if v == city), city)
+            city_name = CITY_BY_CODE[city][0] if city in CITY_BY_CODE else city
             status_text = "✅ Подписан" if subscribed else "❌ Не подписан"
             await update.message.reply_text(
                 f"🏠 Город: {city_name}\n⏰ Часовой пояс: {tz}\n📩 Статус: {status_text}"
@@ -375,34 +607,18 @@ async def status(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 
 async def get_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [[InlineKeyboardButton(city, callback_data=f"set_city_{city}")] for city in CITIES]
-    await update.message.reply_text("Выберите город:", reply_markup=InlineKeyboardMarkup(keyboard))
+    await update.message.reply_text("Выберите город:", reply_markup=CITY_KEYBOARD)
 
 
 async def settings(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    keyboard = [
-        [InlineKeyboardButton("🏠 Изменить город", callback_data="change_city")],
-        [InlineKeyboardButton("ℹ️ Текущие настройки", callback_data="show_settings")]
-    ]
-    commands_list = (
-        "⚙️ *Настройки*\n"
-        "Список доступных команд:\n"
-        "/start - ℹ️ Начало работы с ботом\n"
-        "/set_city _- 🏠 Выбрать город вручную\n"
-        "/status - ℹ️ Показать текущие настройки\n"
-        "/daily_quote _- 📖 Аят дня\n"
-        "/subscribe - ✅ Подписаться на уведомления\n"
-        "/unsubscribe - ❌ Отписаться от уведомлений\n\n"
-        "Выберите действие ниже:"
-    )
-    await update.message.reply_text(commands_list, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+    await update.message.reply_text(SETTINGS_TEXT, reply_markup=SETTINGS_KEYBOARD, parse_mode='Markdown')
 
 
 async def set_city(update: Update, context: ContextTypes.DEFAULT_TYPE):
     query = update.callback_query
     city_name = query.data.split('_')[-1]
     city_code = CITIES[city_name]
-    timezone = CITY_TIMEZONES[city_code]
+    timezone = CITY_BY_CODE[city_code][1]
     chat_id = query.message.chat_id
     update_user(chat_id, city_code, timezone)
     await query.answer(f"Город установлен: {city_name}")
@@ -415,18 +631,15 @@ async def handle_settings_callback(update: Update, context: ContextTypes.DEFAULT
     data = query.data
 
     if data == "change_city":
-        keyboard = [[InlineKeyboardButton(city, callback_data=f"set_city_{city}")] for city in CITIES]
-        keyboard.append([InlineKeyboardButton("⬅️ Назад", callback_data="back_to_settings")])
-        await query.edit_message_text("Выберите город:", reply_markup=InlineKeyboardMarkup(keyboard))
+        await query.edit_message_text("Выберите город:", reply_markup=CITY_KEYBOARD_WITH_BACK)
     elif data == "show_settings":
         try:
-            with sqlite3.connect(DATABASE) as conn:
-                cursor = conn.cursor()
+            with db_read() as cursor:
                 cursor.execute("SELECT city, timezone, subscribed FROM subscribers WHERE chat_id = ?", (chat_id,))
                 result = cursor.fetchone()
             if result:
                 city, tz, subscribed = result
-                city_name = next((k for k, v in CITIES.items() if v == city), city)
+                city_name = CITY_BY_CODE[city][0] if city in CITY_BY_CODE else city
                 status_text = "✅ Подписан" if subscribed else "❌ Не подписан"
                 settings_text = f"🏠 Город: {city_name}\n⏰ Часовой пояс: {tz}\n📩 Статус: {status_text}"
             else:
@@ -436,22 +649,7 @@ async def handle_settings_callback(update: Update, context: ContextTypes.DEFAULT
             logger.error(f"Ошибка при показе настроек для {chat_id}: {e}")
             await query.edit_message_text("❌ Произошла ошибка")
     elif data == "back_to_settings":
-        keyboard = [
-            [InlineKeyboardButton("🏠 Изменить город", callback_data="change_city")],
-            [InlineKeyboardButton("ℹ️ Текущие настройки", callback_data="show_settings")]
-        ]
-        commands_list = (
-            "⚙️ *Настройки*\n"
-            "Список доступных команд:\n"
-            "/start - ℹ️ Начало работы с ботом\n"
-            "/set_city _- 🏠 Выбрать город вручную\n"
-            "/status - ℹ️ Показать текущие настройки\n"
-            "/daily_quote _- 📖 Аят дня\n"
-            "/subscribe - ✅ Подписаться на уведомления\n"
-            "/unsubscribe - ❌ Отписаться от уведомлений\n\n"
-            "Выберите действие ниже:"
-        )
-        await query.edit_message_text(commands_list, reply_markup=InlineKeyboardMarkup(keyboard), parse_mode='Markdown')
+        await query.edit_message_text(SETTINGS_TEXT, reply_markup=SETTINGS_KEYBOARD, parse_mode='Markdown')
 
     await query.answer()
 
@@ -459,15 +657,13 @@ async def handle_settings_callback(update: Update, context: ContextTypes.DEFAULT
 async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
     chat_id = update.effective_chat.id
     try:
-        with sqlite3.connect(DATABASE) as conn:
-            cursor = conn.cursor()
-            cursor.execute("SELECT city FROM subscribers WHERE chat_id = ?", (chat_id,))
-            result = cursor.fetchone()
-            if not result:
-                await update.message.reply_text("❌ Сначала установите город с помощью /set_city")
-                return
-            cursor.execute("UPDATE subscribers SET subscribed = 1 WHERE chat_id = ?", (chat_id,))
-            conn.commit()
+        with db_write() as cursor:
+            cursor.execute('''UPDATE subscribers SET subscribed = 1
+                             WHERE chat_id = ? AND city IS NOT NULL RETURNING city''', (chat_id,))
+            result = cursor.fetchall()
+        if not result:
+            await update.message.reply_text("❌ Сначала установите город с помощью /set_city")
+            return
         await update.message.reply_text("✅ Вы подписаны на уведомления!")
         logger.info(f"Пользователь {chat_id} подписан на уведомления")
     except Error as e:
@@ -481,78 +677,53 @@ async def unsubscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("❌ Вы отписались от уведомлений!")
 
 
-async def check_prayer_times(context: CallbackContext):
-    logger.info("Запуск проверки времени намаза")
-    users = get_subscribed_users()
-    if not users:
-        logger.warning("Нет подписанных пользователей")
-        return
-
-    now = datetime.datetime.now(pytz.utc)
-    cutoff_date = now - datetime.timedelta(days=1)
-    global sent_notifications
-
-    cleaned_notifications = {}
-    for k, v in sent_notifications.items():
-        try:
-            date_part = k.split('-')[0]
-            if len(date_part) == 10 and date_part[4] == '-' and date_part[7] == '-':
-                if datetime.datetime.strptime(date_part, '%Y-%m-%d') > cutoff_date:
-                    cleaned_notifications[k] = v
-            else:
-                logger.warning(f"Удален некорректный ключ уведомления: {k}")
-        except ValueError as e:
-            logger.error(f"Ошибка обработки ключа {k}: {e}")
-    sent_notifications = cleaned_notifications
+# Диспетчер кнопок главного меню: один MessageHandler вместо трёх
+MENU_HANDLERS = {
+    MENU_SCHEDULE: daily_schedule,
+    MENU_AYAT: daily_quote,
+    MENU_SETTINGS: settings,
+}
 
-    for user in users:
-        try:
-            city = user['city']
-            tz = pytz.timezone(user['tz'])
-            now = datetime.datetime.now(tz)
-            today = now.date()
-            current_time = now.strftime("%H:%M")
-            logger.info(f"Проверка для {user['chat_id']}: текущее время {current_time}")
-
-            schedule = await parse_prayer_times(city, today)
-            if not schedule:
-                logger.warning(f"Расписание для {city} пустое")
-                continue
 
-            logger.debug(f"Расписание для {city}: {schedule}")
-            for prayer, time in schedule.items():
-                prayer_minutes = sum(x * int(t) for x, t in zip([60, 1], time.split(":")))
-                current_minutes = sum(x * int(t) for x, t in zip([60, 1], current_time.split(":")))
-                time_diff = prayer_minutes - current_minutes
-
-                notification_id = f"{today.strftime('%Y-%m-%d')}-{prayer}-{user['chat_id']}"
-                if time_diff == 0 and notification_id not in sent_notifications:
-                    await context.bot.send_message(
-                        chat_id=user['chat_id'],
-                        text=f"🕌 Время <u>{prayer}</u> намаза: <b>{time}</b>",
-                        parse_mode='HTML'
-                    )
-                    sent_notifications[notification_id] = True
-                    logger.info(f"Уведомление о {prayer} отправлено для {user['chat_id']} в {time}")
-        except Exception as e:
-            logger.error(f"Ошибка для пользователя {user['chat_id']}: {e}")
+async def handle_menu(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await MENU_HANDLERS[update.message.text](update, context)
 
 
 async def post_init(application: Application):
-    global sent_notifications, sent_daily_schedules
-    sent_notifications = {}
-    sent_daily_schedules = {}
+    global SESSION
+    SESSION = aiohttp.ClientSession(
+        connector=aiohttp.TCPConnector(limit=20, ttl_dns_cache=300, keepalive_timeout=75),
+        headers={'User-Agent': 'Mozilla/5.0'}
+    )
     await update_data()
+    if application.job_queue:
+        await schedule_jobs(application.job_queue)
     logger.info("Данные успешно загружены при старте")
 
 
+async def post_shutdown(application: Application):
+    if SESSION is not None:
+        await SESSION.close()
+
+
 def main():
-    init_db()
+    if not TOKEN:
+        logger.error("Не задан BOT_TOKEN в переменных окружения")
+        return
+    # Без соединения с БД все обработчики и задания будут падать: не запускаемся
+    if not init_db():
+        return
     try:
         application = (
             Application.builder()
             .token(TOKEN)
+            .concurrent_updates(True)
+            .http_version("2.0")
+            .get_updates_http_version("2.0")
+            # Не больше 30 сообщений в секунду, RetryAfter повторяется, а не теряет рассылку
+            .rate_limiter(AIORateLimiter(overall_max_rate=30, max_retries=3))
             .post_init(post_init)
+            .post_shutdown(post_shutdown)
             .build()
         )
 
@@ -562,9 +733,7 @@ def main():
         application.add_handler(CommandHandler("daily_quote", daily_quote))
         application.add_handler(CommandHandler("subscribe", subscribe))
         application.add_handler(CommandHandler("unsubscribe", unsubscribe))
-        application.add_handler(MessageHandler(filters.Text("📅 Расписание на сегодня"), daily_schedule))
-        application.add_handler(MessageHandler(filters.Text("📖 Аят дня"), daily_quote))
-        application.add_handler(MessageHandler(filters.Text("⚙️ Настройки"), settings))
+        application.add_handler(MessageHandler(filters.Text(set(MENU_HANDLERS)), handle_menu))
 
         application.add_handler(CallbackQueryHandler(set_city, pattern="^set_city_"))
         application.add_handler(
@@ -572,10 +741,7 @@ def main():
 
         job_queue = application.job_queue
         if job_queue:
-            job_queue.run_repeating(check_prayer_times, interval=60)
-            job_queue.run_repeating(send_daily_prayer_schedule, interval=60)
-            job_queue.run_repeating(send_daily_quote, interval=60)  # Проверка каждые 60 секунд для 8:00
-            job_queue.run_daily(update_data, time=datetime.time(1, 0, 0, tzinfo=pytz.timezone('Europe/Moscow')))
+            job_queue.run_daily(update_data, time=datetime.time(1, 0, 0, tzinfo=MSK))
 
         application.run_polling()
     except Exception as e: